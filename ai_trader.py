@@ -1,68 +1,23 @@
-import json
-from typing import Dict, Optional, Tuple
-from openai import OpenAI, APIConnectionError, APIError
+import asyncio
+import re
+import traceback
+from typing import Dict, List, Optional, Tuple
+import httpx
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-class AITrader:
-    def __init__(self, provider_type: str, api_key: str, api_url: str, model_name: str):
-        self.provider_type = provider_type.lower()
-        self.api_key = api_key
-        self.api_url = api_url
-        self.model_name = model_name
-    
-    def make_decision(self, market_state: Dict, portfolio: Dict, 
-                     account_info: Dict) -> Dict:
-        prompt = self._build_prompt(market_state, portfolio, account_info)
-        
-        response = self._call_llm(prompt)
-        
-        decisions, cot_trace = self._parse_response(response)
-        
-        return {
-            'decisions': decisions,
-            'prompt': prompt,
-            'raw_response': response,
-            'cot_trace': cot_trace
-        }
-    
-    def _build_prompt(self, market_state: Dict, portfolio: Dict, 
-                     account_info: Dict) -> str:
-        prompt = """你是一名专业的A股量化交易员，负责在合规前提下为账户制定交易计划。
+from decision_cache import ExactDecisionCache, SemanticDecisionCache, default_max_age
+
+# 模型回复中 ```json ... ``` 代码块里的JSON对象
+_FENCE_RE = re.compile(r'```(?:json)?\s*(\{.*?\})\s*```', re.S)
+
+# 固定的人设/交易规则/输出格式放在system消息中，作为稳定前缀以命中服务端的提示词缓存
+STATIC_SYSTEM = """You are a professional Chinese A-share equity trader. Output JSON format only.
+
+你是一名专业的A股量化交易员，负责在合规前提下为账户制定交易计划。
 
-市场行情 (价格单位：人民币)：
-"""
-        for symbol, data in market_state.items():
-            price = data.get('price', 0)
-            info = f"{symbol}: {price:.2f}元"
-            change_5d = data.get('indicators', {}).get('change_5d') if data.get('indicators') else None
-            change_20d = data.get('indicators', {}).get('change_20d') if data.get('indicators') else None
-            if change_5d is not None:
-                info += f" | 5日涨跌: {change_5d:+.2f}%"
-            if change_20d is not None:
-                info += f" | 20日涨跌: {change_20d:+.2f}%"
-            prompt += info + "\n"
-            indicators = data.get('indicators')
-            if indicators:
-                prompt += (
-                    f"  SMA5: {indicators.get('sma_5', 0):.2f}, SMA20: {indicators.get('sma_20', 0):.2f}, "
-                    f"RSI14: {indicators.get('rsi_14', 0):.1f}\n"
-                )
-        
-        prompt += f"""
-账户状态:
-- 初始资金: ¥{account_info['initial_capital']:.2f}
-- 账户总值: ¥{portfolio['total_value']:.2f}
-- 可用现金: ¥{portfolio['cash']:.2f}
-- 总收益率: {account_info['total_return']:.2f}%
-
-当前持仓:
-"""
-        if portfolio['positions']:
-            for pos in portfolio['positions']:
-                prompt += f"- {pos['coin']} {pos['side']} {pos['quantity']:.2f} 股 @ ¥{pos['avg_price']:.2f}\n"
-        else:
-            prompt += "None\n"
-        
-        prompt += """
 交易约束:
 1. 仅允许 buy_to_enter (买入开仓)、close_position (卖出平仓)、hold (观望)。暂不支持融券做空。
 2. 保持持仓数量≤3，只在具备明显优势时开新仓。
@@ -95,168 +50,355 @@ class AITrader:
 - `cot_trace` 用于记录3-5步推理过程，可为字符串数组。
 - `decisions` 字段同上，只列出需要动作的股票。
 """
+
+# 用户提示词中的固定段落，模块加载时构建一次
+_ACCOUNT_TEMPLATE = """账户状态:
+- 初始资金: ¥{initial_capital:.2f}
+- 账户总值: ¥{total_value:.2f}
+- 可用现金: ¥{cash:.2f}
+- 总收益率: {total_return:.2f}%
+
+当前持仓:"""
+
+_MARKET_HEADER = "\n市场行情 (价格单位：人民币)："
+
+class _OpenAIAdapter:
+    """OpenAI-compatible chat completions (OpenAI / Azure OpenAI / DeepSeek)"""
+    name = 'OpenAI'
+
+    def base_url(self, api_url: str) -> str:
+        base_url = api_url.rstrip('/')
+        if not base_url.endswith('/v1'):
+            if '/v1' in base_url:
+                base_url = base_url.split('/v1')[0] + '/v1'
+            else:
+                base_url = base_url + '/v1'
+        return base_url
+
+    def build_request(self, trader: 'AITrader', system: str, user: str) -> Tuple[str, Dict, Dict, Dict]:
+        url = f"{trader._base_url}/chat/completions"
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {trader.api_key}'
+        }
+        data = {
+            "model": trader.model_name,
+            "messages": [
+                {"role": "system", "content": system},
+                {"role": "user", "content": user}
+            ],
+            "temperature": 0.7,
+            "max_tokens": 2000
+        }
+        return url, headers, {}, data
+
+    def extract_text(self, result: Dict) -> str:
+        return result['choices'][0]['message']['content']
+
+
+class _V1SuffixAdapter:
+    """Base for providers whose base URL is the configured URL with a trailing /v1"""
+
+    def base_url(self, api_url: str) -> str:
+        base_url = api_url.rstrip('/')
+        return base_url if base_url.endswith('/v1') else base_url + '/v1'
+
+
+class _AnthropicAdapter(_V1SuffixAdapter):
+    name = 'Anthropic'
+
+    def build_request(self, trader: 'AITrader', system: str, user: str) -> Tuple[str, Dict, Dict, Dict]:
+        url = f"{trader._base_url}/messages"
+        headers = {
+            'Content-Type': 'application/json',
+            'x-api-key': trader.api_key,
+            'anthropic-version': '2023-06-01'
+        }
+        data = {
+            "model": trader.model_name,
+            "max_tokens": 2000,
+            "system": [
+                {
+                    "type": "text",
+                    "text": system,
+                    "cache_control": {"type": "ephemeral"}
+                }
+            ],
+            "messages": [
+                {
+                    "role": "user",
+                    "content": user
+                }
+            ]
+        }
+        return url, headers, {}, data
+
+    def extract_text(self, result: Dict) -> str:
+        return result['content'][0]['text']
+
+
+class _GeminiAdapter(_V1SuffixAdapter):
+    name = 'Gemini'
+
+    def build_request(self, trader: 'AITrader', system: str, user: str) -> Tuple[str, Dict, Dict, Dict]:
+        url = f"{trader._base_url}/{trader.model_name}:generateContent"
+        headers = {
+            'Content-Type': 'application/json'
+        }
+        params = {'key': trader.api_key}
+        data = {
+            "contents": [
+                {
+                    "parts": [
+                        {"text": system},
+                        {"text": user}
+                    ]
+                }
+            ],
+            "generationConfig": {
+                "temperature": 0.7,
+                "maxOutputTokens": 2000
+            }
+        }
+        return url, headers, params, data
+
+    def extract_text(self, result: Dict) -> str:
+        return result['candidates'][0]['content']['parts'][0]['text']
+
+
+# provider_type -> 请求适配器；未知类型按OpenAI兼容接口处理
+PROVIDERS = {
+    'openai': _OpenAIAdapter(),
+    'azure_openai': _OpenAIAdapter(),
+    'deepseek': _OpenAIAdapter(),
+    'anthropic': _AnthropicAdapter(),
+    'gemini': _GeminiAdapter(),
+}
+
+
+class AITrader:
+    def __init__(self, provider_type: str, api_key: str, api_url: str, model_name: str):
+        self.provider_type = provider_type.lower()
+        self.api_key = api_key
+        self.api_url = api_url
+        self.model_name = model_name
+        self._exact_cache = ExactDecisionCache()
+        self._semantic_cache = SemanticDecisionCache()
+
+        self._adapter = PROVIDERS.get(self.provider_type, PROVIDERS['openai'])
+        self._base_url = self._adapter.base_url(self.api_url)
+        self._timeout = 60
+
+        # 复用连接池：每个进程每个提供方只做一次TCP/TLS握手
+        self._http = requests.Session()
+        pooled = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=16,
+            max_retries=Retry(
+                total=2,
+                read=0,   # 读超时/读错误不重放：生成可能已在服务端执行并计费
+                other=0,
+                backoff_factor=0.3,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=frozenset(['POST']),
+                raise_on_status=False
+            )
+        )
+        self._http.mount('https://', pooled)
+        self._http.mount('http://', pooled)
+        # async with trader: 期间复用的异步客户端；否则每次异步调用临时创建并关闭
+        self._ahttp = None
+    
+    def set_cycle_interval(self, interval_seconds: float):
+        """Align decision cache lifetime with the effective trading interval (settings may change at runtime)"""
+        max_age = default_max_age(interval_seconds)
+        self._exact_cache.max_age = max_age
+        self._semantic_cache.max_age = max_age
+    
+    def make_decision(self, market_state: Dict, portfolio: Dict, 
+                     account_info: Dict) -> Dict:
+        """Decide for every symbol in market_state with a single LLM call.
+
+        The prompt already covers the whole universe, so callers must pass the full
+        market_state once per cycle instead of calling this in a per-symbol loop.
+        """
+        prompt = self._build_prompt(market_state, portfolio, account_info)
+        
+        cache_key, cached = self._lookup_cached_decision(market_state, portfolio)
+        if cached is not None:
+            return {**cached, 'prompt': prompt}
         
-        return prompt
+        response = self._call_llm(prompt)
+        
+        return self._finish_decision(prompt, response, market_state, cache_key)
     
-    def _call_llm(self, prompt: str) -> str:
-        """Call LLM API based on provider type"""
-        # OpenAI-compatible providers (same format)
-        if self.provider_type in ['openai', 'azure_openai', 'deepseek']:
-            return self._call_openai_api(prompt)
-        elif self.provider_type == 'anthropic':
-            return self._call_anthropic_api(prompt)
-        elif self.provider_type == 'gemini':
-            return self._call_gemini_api(prompt)
-        else:
-            # Default to OpenAI-compatible API
-            return self._call_openai_api(prompt)
+    async def amake_decision(self, market_state: Dict, portfolio: Dict,
+                             account_info: Dict) -> Dict:
+        """Async variant of make_decision so independent LLM calls can overlap"""
+        prompt = self._build_prompt(market_state, portfolio, account_info)
+        
+        cache_key, cached = self._lookup_cached_decision(market_state, portfolio)
+        if cached is not None:
+            return {**cached, 'prompt': prompt}
+        
+        response = await self._acall_llm(prompt)
+        
+        return self._finish_decision(prompt, response, market_state, cache_key)
     
-    def _call_openai_api(self, prompt: str) -> str:
-        """Call OpenAI-compatible API"""
-        try:
-            base_url = self.api_url.rstrip('/')
-            if not base_url.endswith('/v1'):
-                if '/v1' in base_url:
-                    base_url = base_url.split('/v1')[0] + '/v1'
-                else:
-                    base_url = base_url + '/v1'
-            
-            client = OpenAI(
-                api_key=self.api_key,
-                base_url=base_url
-            )
-            
-            response = client.chat.completions.create(
-                model=self.model_name,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "You are a professional Chinese A-share equity trader. Output JSON format only."
-                    },
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
-                temperature=0.7,
-                max_tokens=2000
+    def _lookup_cached_decision(self, market_state: Dict, portfolio: Dict) -> Tuple[Tuple, Optional[Dict]]:
+        # 行情完全相同时直接查字典，不必计算向量；否则再尝试近似行情的语义缓存
+        exact_key = self._exact_cache.make_key(market_state, portfolio)
+        cached = self._exact_cache.get(exact_key)
+        if cached is not None:
+            return (exact_key, None), {**cached, 'cache_hit': 'exact'}
+        
+        semantic_key = self._semantic_cache.make_key(market_state, portfolio)
+        cached = self._semantic_cache.get(semantic_key)
+        if cached is not None:
+            self._exact_cache.put(exact_key, cached)
+            return (exact_key, semantic_key), {**cached, 'cache_hit': 'semantic'}
+        return (exact_key, semantic_key), None
+    
+    def _finish_decision(self, prompt: str, response: str, market_state: Dict,
+                         cache_key: Tuple) -> Dict:
+        decisions, cot_trace = self._parse_response(response, list(market_state.keys()))
+        
+        result = {
+            'decisions': decisions,
+            'raw_response': response,
+            'cot_trace': cot_trace
+        }
+        if decisions:
+            exact_key, semantic_key = cache_key
+            self._exact_cache.put(exact_key, result)
+            self._semantic_cache.put(semantic_key, result)
+        
+        return {**result, 'prompt': prompt}
+    
+    def make_decisions_batch(self, market_states_by_symbol: Dict, portfolio: Dict,
+                             account_info: Dict) -> Dict[str, Dict]:
+        """Return {symbol: decision} for all symbols, sharing one LLM call.
+
+        Every requested symbol is present (missing ones are filled with hold) unless
+        the response could not be parsed, in which case the dict is empty.
+        """
+        return self.make_decision(market_states_by_symbol, portfolio, account_info)['decisions']
+    
+    def _build_prompt(self, market_state: Dict, portfolio: Dict, 
+                     account_info: Dict) -> str:
+        """Build the dynamic user prompt; static rules live in STATIC_SYSTEM.
+
+        Least-changing content (account) goes first and live prices last so the
+        provider-side prompt cache can reuse as much of the prefix as possible.
+        """
+        lines = [_ACCOUNT_TEMPLATE.format(
+            initial_capital=account_info['initial_capital'],
+            total_value=portfolio['total_value'],
+            cash=portfolio['cash'],
+            total_return=account_info['total_return'],
+        )]
+        if portfolio['positions']:
+            lines.extend(
+                f"- {pos['coin']} {pos['side']} {pos['quantity']:.2f} 股 @ ¥{pos['avg_price']:.2f}"
+                for pos in portfolio['positions']
             )
-            
-            return response.choices[0].message.content
-            
-        except APIConnectionError as e:
-            error_msg = f"API connection failed: {str(e)}"
-            print(f"[ERROR] {error_msg}")
-            raise Exception(error_msg)
-        except APIError as e:
-            error_msg = f"API error ({e.status_code}): {e.message}"
-            print(f"[ERROR] {error_msg}")
-            raise Exception(error_msg)
-        except Exception as e:
-            error_msg = f"OpenAI API call failed: {str(e)}"
-            print(f"[ERROR] {error_msg}")
-            import traceback
-            print(traceback.format_exc())
-            raise Exception(error_msg)
+        else:
+            lines.append("None")
+        
+        lines.append(_MARKET_HEADER)
+        for symbol, data in market_state.items():
+            indicators = data.get('indicators')
+            info = f"{symbol}: {data.get('price', 0):.2f}元"
+            if indicators:
+                change_5d = indicators.get('change_5d')
+                change_20d = indicators.get('change_20d')
+                if change_5d is not None:
+                    info += f" | 5日涨跌: {change_5d:+.2f}%"
+                if change_20d is not None:
+                    info += f" | 20日涨跌: {change_20d:+.2f}%"
+            lines.append(info)
+            if indicators:
+                lines.append(
+                    f"  SMA5: {indicators.get('sma_5', 0):.2f}, SMA20: {indicators.get('sma_20', 0):.2f}, "
+                    f"RSI14: {indicators.get('rsi_14', 0):.1f}"
+                )
+        lines.append('')
+        
+        return '\n'.join(lines)
     
-    def _call_anthropic_api(self, prompt: str) -> str:
-        """Call Anthropic Claude API"""
+    def _call_llm(self, prompt: str) -> str:
+        """Call LLM API through the provider adapter"""
         try:
-            import requests
-            
-            base_url = self.api_url.rstrip('/')
-            if not base_url.endswith('/v1'):
-                base_url = base_url + '/v1'
-            
-            url = f"{base_url}/messages"
-            headers = {
-                'Content-Type': 'application/json',
-                'x-api-key': self.api_key,
-                'anthropic-version': '2023-06-01'
-            }
-            
-            data = {
-                "model": self.model_name,
-                "max_tokens": 2000,
-                "system": "You are a professional Chinese A-share equity trader. Output JSON format only.",
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ]
-            }
+            url, headers, params, data = self._adapter.build_request(self, STATIC_SYSTEM, prompt)
             
-            response = requests.post(url, headers=headers, json=data, timeout=60)
+            response = self._http.post(url, headers=headers, params=params, data=orjson.dumps(data), timeout=self._timeout)
             response.raise_for_status()
             
-            result = response.json()
-            return result['content'][0]['text']
+            return self._adapter.extract_text(orjson.loads(response.content))
             
         except Exception as e:
-            error_msg = f"Anthropic API call failed: {str(e)}"
-            print(f"[ERROR] {error_msg}")
-            import traceback
-            print(traceback.format_exc())
-            raise Exception(error_msg)
+            raise self._call_failed(e)
     
-    def _call_gemini_api(self, prompt: str) -> str:
-        """Call Google Gemini API"""
+    async def _acall_llm(self, prompt: str) -> str:
+        """Async counterpart of _call_llm"""
+        client = self._ahttp
+        owned = client is None
         try:
-            import requests
+            if owned:
+                client = self._new_async_client()
+            url, headers, params, data = self._adapter.build_request(self, STATIC_SYSTEM, prompt)
             
-            base_url = self.api_url.rstrip('/')
-            if not base_url.endswith('/v1'):
-                base_url = base_url + '/v1'
-            
-            url = f"{base_url}/{self.model_name}:generateContent"
-            headers = {
-                'Content-Type': 'application/json'
-            }
-            params = {'key': self.api_key}
-            
-            data = {
-                "contents": [
-                    {
-                        "parts": [
-                            {
-                                "text": f"You are a professional Chinese A-share equity trader. Output JSON format only.\n\n{prompt}"
-                            }
-                        ]
-                    }
-                ],
-                "generationConfig": {
-                    "temperature": 0.7,
-                    "maxOutputTokens": 2000
-                }
-            }
-            
-            response = requests.post(url, headers=headers, params=params, json=data, timeout=60)
+            response = await client.post(url, headers=headers, params=params, content=orjson.dumps(data))
             response.raise_for_status()
             
-            result = response.json()
-            return result['candidates'][0]['content']['parts'][0]['text']
+            return self._adapter.extract_text(orjson.loads(response.content))
             
         except Exception as e:
-            error_msg = f"Gemini API call failed: {str(e)}"
-            print(f"[ERROR] {error_msg}")
-            import traceback
-            print(traceback.format_exc())
-            raise Exception(error_msg)
+            raise self._call_failed(e)
+        finally:
+            if owned and client is not None:
+                await client.aclose()
     
+    def _call_failed(self, error: Exception) -> Exception:
+        error_msg = f"{self._adapter.name} API call failed: {str(error)}"
+        print(f"[ERROR] {error_msg}")
+        print(traceback.format_exc())
+        return Exception(error_msg)
     
-    def _parse_response(self, response: str) -> Tuple[Dict, Optional[str]]:
-        response = response.strip()
-        
-        if '```json' in response:
-            response = response.split('```json')[1].split('```')[0]
-        elif '```' in response:
-            response = response.split('```')[1].split('```')[0]
+    def _new_async_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            timeout=self._timeout,
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=4),
+            transport=httpx.AsyncHTTPTransport(retries=2)
+        )
+    
+    async def __aenter__(self) -> 'AITrader':
+        """Keep one pooled async client open for the block.
+
+        An httpx.AsyncClient is bound to the event loop it was used on and cannot be
+        closed once that loop is gone, so its lifetime is scoped to this block.
+        """
+        if self._ahttp is None:
+            self._ahttp = self._new_async_client()
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+    
+    async def aclose(self):
+        """Close the pooled async client opened by `async with trader:`"""
+        if self._ahttp is not None:
+            await self._ahttp.aclose()
+        self._ahttp = None
+    
+    def _parse_response(self, response: str, symbols: Optional[List[str]] = None) -> Tuple[Dict, Optional[str]]:
+        match = _FENCE_RE.search(response)
+        payload = match.group(1) if match else response.strip()
         
         cot_trace = None
         decisions: Dict = {}
         try:
-            parsed = json.loads(response.strip())
+            parsed = orjson.loads(payload)
             if isinstance(parsed, dict) and 'decisions' in parsed:
                 cot_trace = parsed.get('cot_trace')
                 decisions = parsed.get('decisions') or {}
@@ -264,14 +406,24 @@ class AITrader:
                 decisions = parsed
             else:
                 decisions = {}
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             print(f"[ERROR] JSON parse failed: {e}")
-            print(f"[DATA] Response:\n{response}")
-            decisions = {}
+            print(f"[DATA] Response:\n{payload}")
+            return {}, None
         
         if not isinstance(decisions, dict):
             decisions = {}
         
+        # 信号在解析时统一转为小写，下游直接按字典分发
+        for decision in decisions.values():
+            if isinstance(decision, dict) and isinstance(decision.get('signal'), str):
+                decision['signal'] = decision['signal'].lower()
+        
+        # 模型只列出需要动作的股票，其余标的补齐为观望，不再重新请求
+        for symbol in symbols or []:
+            if symbol not in decisions:
+                decisions[symbol] = {'signal': 'hold', 'justification': '模型未给出决策，默认观望'}
+        
         return decisions, self._stringify_cot_trace(cot_trace)
 
     def _stringify_cot_trace(self, cot_trace) -> Optional[str]:
@@ -287,9 +439,21 @@ class AITrader:
                     if step:
                         cleaned.append(step)
                 else:
-                    cleaned.append(json.dumps(item, ensure_ascii=False))
+                    cleaned.append(orjson.dumps(item).decode())
             return '\n'.join(cleaned) or None
         try:
-            return json.dumps(cot_trace, ensure_ascii=False)
+            return orjson.dumps(cot_trace).decode()
         except TypeError:
             return str(cot_trace)
+
+
+async def gather_decisions(traders: List[AITrader], market_state: Dict, portfolio: Dict,
+                           account_info: Dict) -> List:
+    """Query several traders concurrently (ensemble); latency is max(Ti) instead of sum(Ti).
+
+    Failed providers are returned as exceptions in their slot.
+    """
+    return await asyncio.gather(
+        *(trader.amake_decision(market_state, portfolio, account_info) for trader in traders),
+        return_exceptions=True
+    )
@@ -20,9 +20,28 @@ except ImportError:  # pragma: no cover
 app = Flask(__name__)
 CORS(app)
 
+import atexit
 import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
 logging.getLogger('werkzeug').setLevel(logging.WARNING)
 
+
+def setup_logging():
+    """Route log records through a queue so trading threads never block on stdout writes"""
+    log_queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter('%(message)s'))
+    listener = QueueListener(log_queue, stream_handler)
+    logging.getLogger().addHandler(QueueHandler(log_queue))
+    logging.getLogger('trading_engine').setLevel(logging.INFO)
+    listener.start()
+    return listener
+
+# 导入时即配置：flask run / gunicorn 不会执行 __main__，交易审计日志同样需要输出
+atexit.register(setup_logging().stop)
+
 DEFAULT_DB_PATH = 'trading_bot.db'
 env_db_path = os.getenv('DATABASE_PATH')
 config_db_path = getattr(app_config, 'DATABASE_PATH', None)
@@ -59,11 +78,24 @@ def init_trading_engine_for_model(model_id: int):
     return trading_engines[model_id], None
 
 def get_tracked_symbols():
-    symbols = db.get_stock_symbols()
+    symbols = market_fetcher.get_configured_symbols()
     if not symbols:
         print('[WARN] No stocks configured. Please add stocks via /api/stocks.')
     return symbols
 
+def reload_stock_configs():
+    """Propagate stock config changes to the market data cache and running engines"""
+    market_fetcher.invalidate_stocks_cache()
+    for engine in list(trading_engines.values()):
+        engine.reload_symbols()
+
+def sync_decision_cache_interval(interval_seconds: int = None):
+    """Keep AI decision cache lifetimes in step with the configured trading frequency"""
+    if interval_seconds is None:
+        interval_seconds = get_trading_interval_seconds()
+    for engine in list(trading_engines.values()):
+        engine.ai_trader.set_cycle_interval(interval_seconds)
+
 def get_trading_interval_seconds() -> int:
     """Read trading frequency from settings (minutes) and return seconds."""
     default_interval_seconds = getattr(app_config, 'TRADING_INTERVAL', 3600)
@@ -185,6 +217,7 @@ def add_stock_config():
 
     try:
         stock_id = db.add_stock(symbol, name, exchange, api_symbol)
+        reload_stock_configs()
         return jsonify({'id': stock_id, 'message': 'Stock added successfully'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -193,6 +226,7 @@ def add_stock_config():
 def delete_stock_config(stock_id):
     try:
         db.delete_stock(stock_id)
+        reload_stock_configs()
         return jsonify({'message': 'Stock deleted successfully'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -392,7 +426,8 @@ def execute_trading(model_id):
     db.set_model_auto_trading(model_id, True)
 
     try:
-        result = engine.execute_trading_cycle()
+        # 手动触发时用户明确要求决策，不走空闲闸门
+        result = engine.execute_trading_cycle(use_idle_gate=False)
         result['auto_trading_enabled'] = True
         return jsonify(result)
     except Exception as e:
@@ -432,6 +467,7 @@ def trading_loop():
             print(f"[CYCLE] {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
             print(f"[INFO] Active models: {len(trading_engines)}")
             print(f"{'='*60}")
+            sync_decision_cache_interval()
             
             for model_id, engine in list(trading_engines.items()):
                 try:
@@ -533,6 +569,7 @@ def update_settings():
         )
 
         if success:
+            sync_decision_cache_interval()
             return jsonify({'success': True, 'message': 'Settings updated successfully'})
         else:
             return jsonify({'success': False, 'error': 'Failed to update settings'}), 500
@@ -28,10 +28,27 @@ INITIAL_STOCKS = [
 
 # Market Data
 MARKET_API_CACHE = 5  # seconds
+MARKET_HISTORY_CACHE = 300  # seconds, daily K-line history
 MARKET_API_URL = JQDATA_API_URL
 
 # Refresh Rates (frontend)
 MARKET_REFRESH = 5000  # ms
 PORTFOLIO_REFRESH = 10000  # ms
 TRADE_FEE_RATE = 0.001  # 交易费率：0.1%（双向收费）
-
+ACCOUNT_VALUE_DRIFT = 0.001  # 无成交周期账户总值变动超过0.1%才记录快照
+
+# AI Idle Gate: skip the LLM call while nothing moved since its last decision
+AI_IDLE_GATE_ENABLED = True
+AI_IDLE_PRICE_DRIFT = 0.005  # 任一标的价格相对上次调用变动超过0.5%即调用
+AI_IDLE_MAX_SKIPS = 5  # 最多连续跳过的周期数
+
+# Conversation log
+CONVERSATION_MAX_CHARS = 65536  # 单条提示词/回复入库的最大字符数
+RECORD_HOLD_CONVERSATIONS = False  # 全部观望的周期是否记录AI对话
+
+# AI Decision Cache (semantic cache requires sentence-transformers)
+DECISION_CACHE_ENABLED = True
+DECISION_CACHE_CYCLES = 2  # 缓存有效期 = 实际交易间隔 × 周期数
+SEMANTIC_CACHE_MODEL = 'paraphrase-multilingual-MiniLM-L12-v2'
+SEMANTIC_CACHE_THRESHOLD = 0.97
+SEMANTIC_CACHE_SIZE = 512
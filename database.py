@@ -3,28 +3,73 @@ Database management module
 """
 import sqlite3
 import json
+import threading
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 
 try:
     import config as app_config
 except ImportError:  # pragma: no cover - fallback for environments without config.py
     import config_example as app_config
 
+class _SharedConnection:
+    """Connection handed out inside Database.transaction(); commit/close are deferred to the transaction"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self._conn = conn
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
 class Database:
     def __init__(self, db_path: str = 'trading_bot.db'):
         self.db_path = db_path
+        self._local = threading.local()
         
     def get_connection(self):
         """Get database connection"""
+        shared = getattr(self._local, 'conn', None)
+        if shared is not None:
+            return shared
         conn = sqlite3.connect(self.db_path)
         conn.row_factory = sqlite3.Row
+        # WAL模式下NORMAL同步足够安全，且写入不必每次fsync
+        conn.execute('PRAGMA synchronous=NORMAL')
         return conn
     
+    @contextmanager
+    def transaction(self):
+        """Group the write methods called in this thread into a single commit"""
+        if getattr(self._local, 'conn', None) is not None:
+            # 嵌套调用并入外层事务
+            yield
+            return
+        conn = self.get_connection()
+        self._local.conn = _SharedConnection(conn)
+        try:
+            yield
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._local.conn = None
+            conn.close()
+    
     def init_db(self):
         """Initialize database tables"""
         conn = self.get_connection()
         cursor = conn.cursor()
+        # WAL：读写互不阻塞（该设置持久化在数据库文件中）
+        cursor.execute('PRAGMA journal_mode=WAL')
 
         # Providers table (API提供方)
         cursor.execute('''
@@ -257,6 +302,14 @@ class Database:
         ''', (model_id,))
         realized_pnl = cursor.fetchone()['total_pnl']
         
+        conn.close()
+        
+        return self.summarize_portfolio(model_id, positions, initial_capital, realized_pnl, current_prices)
+    
+    @staticmethod
+    def summarize_portfolio(model_id: int, positions: List[Dict], initial_capital: float,
+                            realized_pnl: float, current_prices: Dict = None) -> Dict:
+        """Derive cash/value totals from open positions (shared with in-process portfolio updates)"""
         # Calculate margin used
         margin_used = sum([p['quantity'] * p['avg_price'] / p['leverage'] for p in positions])
         
@@ -298,8 +351,6 @@ class Database:
         # Total account value = initial capital + realized P&L + unrealized P&L
         total_value = initial_capital + realized_pnl + unrealized_pnl
         
-        conn.close()
-        
         return {
             'model_id': model_id,
             'cash': cash,
@@ -391,7 +442,11 @@ class Database:
     
     def add_conversation(self, model_id: int, user_prompt: str, 
                         ai_response: str, cot_trace: str = ''):
-        """Add conversation record"""
+        """Add conversation record (long texts are capped at CONVERSATION_MAX_CHARS)"""
+        max_chars = getattr(app_config, 'CONVERSATION_MAX_CHARS', 65536)
+        user_prompt, ai_response, cot_trace = (
+            self._truncate_text(text, max_chars) for text in (user_prompt, ai_response, cot_trace)
+        )
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute('''
@@ -401,6 +456,12 @@ class Database:
         conn.commit()
         conn.close()
     
+    @staticmethod
+    def _truncate_text(text: Optional[str], max_chars: int) -> Optional[str]:
+        if not text or not max_chars or len(text) <= max_chars:
+            return text
+        return text[:max_chars] + f'\n...[truncated {len(text) - max_chars} chars]'
+    
     def get_conversations(self, model_id: int, limit: int = 20) -> List[Dict]:
         """Get conversation history"""
         conn = self.get_connection()
@@ -609,6 +670,24 @@ class Database:
         conn.commit()
         conn.close()
 
+    def upsert_daily_prices(self, rows: List[Tuple[str, float, str]]):
+        """Store or update many (symbol, price, price_date) rows in one transaction"""
+        rows = [row for row in rows if row[1] is not None]
+        if not rows:
+            return
+
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT INTO daily_prices (symbol, price, price_date)
+            VALUES (?, ?, ?)
+            ON CONFLICT(symbol, price_date) DO UPDATE SET
+                price = excluded.price,
+                updated_at = CURRENT_TIMESTAMP
+        ''', rows)
+        conn.commit()
+        conn.close()
+
     def get_latest_daily_prices(self, symbols: Optional[List[str]] = None) -> Dict[str, Dict]:
         """Get the latest stored closing price per symbol"""
         conn = self.get_connection()
@@ -0,0 +1,218 @@
+"""
+Decision cache module - reuse recent AI decisions for identical or near-duplicate market states.
+The exact cache is always available; the semantic cache is optional and stays disabled
+when sentence-transformers is not installed.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # pragma: no cover - optional dependency
+    np = None
+    SentenceTransformer = None
+
+try:
+    import config as app_config
+except ImportError:  # pragma: no cover
+    import config_example as app_config
+
+
+_PRICE_BUCKET_LOG = math.log(1.005)  # 价格按0.5%分桶
+_CASH_BUCKET_LOG = math.log(1.01)    # 现金按1%分桶
+
+_encoder = None
+_encoder_lock = threading.Lock()
+_encoder_failed = False
+
+
+def _get_encoder():
+    """Load the shared sentence encoder once per process"""
+    global _encoder, _encoder_failed
+    if _encoder is not None or _encoder_failed:
+        return _encoder
+    with _encoder_lock:
+        if _encoder is None and not _encoder_failed:
+            model_name = getattr(app_config, 'SEMANTIC_CACHE_MODEL', 'paraphrase-multilingual-MiniLM-L12-v2')
+            try:
+                _encoder = SentenceTransformer(model_name)
+                print(f'[INFO] Semantic decision cache loaded: {model_name}')
+            except Exception as e:
+                _encoder_failed = True
+                print(f'[WARN] Semantic decision cache disabled, failed to load {model_name}: {e}')
+    return _encoder
+
+
+def _log_bucket(value: float, step_log: float) -> int:
+    return round(math.log(value) / step_log) if value and value > 0 else 0
+
+
+def default_max_age(interval_seconds: float = None) -> float:
+    """Cache lifetime: DECISION_CACHE_CYCLES trading cycles of the effective interval"""
+    if interval_seconds is None:
+        interval_seconds = getattr(app_config, 'TRADING_INTERVAL', 180)
+    return interval_seconds * getattr(app_config, 'DECISION_CACHE_CYCLES', 2)
+
+
+def build_price_buckets(market_state: Dict) -> Dict[str, int]:
+    return {
+        symbol: _log_bucket(data.get('price', 0), _PRICE_BUCKET_LOG)
+        for symbol, data in market_state.items()
+    }
+
+
+def build_state_features(market_state: Dict, portfolio: Dict) -> Tuple[Tuple, str]:
+    """Build (scope, feature text) for a market/portfolio snapshot.
+
+    The scope (tracked symbols + positions) must match exactly; only the bucketed
+    market features are compared semantically.
+    """
+    lines = []
+    price_buckets = build_price_buckets(market_state)
+    for symbol in sorted(market_state):
+        data = market_state[symbol]
+        indicators = data.get('indicators') or {}
+        price_bucket = price_buckets[symbol]
+        rsi_bucket = int(indicators.get('rsi_14', 0) // 5) * 5
+        trend = '多' if indicators.get('sma_5', 0) >= indicators.get('sma_20', 0) else '空'
+        lines.append(f'{symbol} 价格档{price_bucket} RSI{rsi_bucket} 均线{trend}')
+    lines.append(f'现金档{_log_bucket(portfolio.get("cash", 0), _CASH_BUCKET_LOG)}')
+
+    positions = tuple(sorted(
+        (pos['coin'], pos['side'], round(pos['quantity'], 2))
+        for pos in portfolio.get('positions', [])
+    ))
+    scope = (tuple(sorted(market_state)), positions)
+    return scope, '\n'.join(lines)
+
+
+def build_exact_key(market_state: Dict, portfolio: Dict) -> Tuple:
+    """Canonical hashable key of a snapshot (prices to 0.01, RSI to 0.1, cash to 1)"""
+    market = tuple(sorted(
+        (symbol, round(data.get('price', 0), 2), round((data.get('indicators') or {}).get('rsi_14', 0), 1))
+        for symbol, data in market_state.items()
+    ))
+    positions = tuple(sorted(
+        (pos['coin'], pos['side'], round(pos['quantity'], 2))
+        for pos in portfolio.get('positions', [])
+    ))
+    return market, round(portfolio.get('cash', 0)), positions
+
+
+class ExactDecisionCache:
+    """LRU + TTL dict of AI decisions keyed by the exact bucketed snapshot"""
+
+    def __init__(self, max_age: float = None, max_size: int = 256):
+        self.max_age = max_age if max_age is not None else default_max_age()
+        self.max_size = max_size
+        self.enabled = getattr(app_config, 'DECISION_CACHE_ENABLED', True)
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()  # key -> (ts, payload), oldest first
+
+    def make_key(self, market_state: Dict, portfolio: Dict) -> Optional[Tuple]:
+        if not self.enabled or not market_state:
+            return None
+        return build_exact_key(market_state, portfolio)
+
+    def get(self, key: Optional[Tuple]) -> Optional[Dict]:
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[0] > self.max_age:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: Optional[Tuple], payload: Dict):
+        if key is None:
+            return
+        with self._lock:
+            self._entries[key] = (time.time(), payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class SemanticDecisionCache:
+    """LRU cache of AI decisions matched by cosine similarity of state embeddings"""
+
+    def __init__(self, threshold: float = None, max_age: float = None, max_size: int = None):
+        self.threshold = threshold if threshold is not None else getattr(app_config, 'SEMANTIC_CACHE_THRESHOLD', 0.97)
+        self.max_age = max_age if max_age is not None else default_max_age()
+        self.max_size = max_size or getattr(app_config, 'SEMANTIC_CACHE_SIZE', 512)
+        self.enabled = (
+            getattr(app_config, 'DECISION_CACHE_ENABLED', True)
+            and SentenceTransformer is not None
+        )
+        self._lock = threading.Lock()
+        self._entries: List[Dict] = []  # oldest first: {'scope', 'vector', 'buckets', 'payload', 'ts'}
+        self._matrix = None
+
+    def make_key(self, market_state: Dict, portfolio: Dict) -> Optional[Tuple]:
+        """Encode the snapshot into a cache key, or None when the cache is unavailable"""
+        if not self.enabled or not market_state:
+            return None
+        encoder = _get_encoder()
+        if encoder is None:
+            return None
+        scope, text = build_state_features(market_state, portfolio)
+        try:
+            vector = encoder.encode(text, normalize_embeddings=True)
+        except Exception as e:
+            print(f'[WARN] Semantic cache encode failed: {e}')
+            return None
+        return scope, np.asarray(vector, dtype=np.float32), build_price_buckets(market_state)
+
+    def get(self, key: Optional[Tuple]) -> Optional[Dict]:
+        if key is None:
+            return None
+        scope, vector, buckets = key
+        with self._lock:
+            self._evict_expired()
+            if not self._entries:
+                return None
+            if self._matrix is None:
+                self._matrix = np.stack([entry['vector'] for entry in self._entries])
+            scores = self._matrix @ vector
+            for idx in np.argsort(scores)[::-1]:
+                if scores[idx] < self.threshold:
+                    break
+                entry = self._entries[idx]
+                # 句向量对数字变化不敏感：额外要求各标的价格档相差不超过1档
+                if entry['scope'] == scope and self._prices_close(entry['buckets'], buckets):
+                    # LRU: move hit to the newest end
+                    self._entries.append(self._entries.pop(idx))
+                    self._matrix = None
+                    return entry['payload']
+        return None
+
+    def put(self, key: Optional[Tuple], payload: Dict):
+        if key is None:
+            return
+        scope, vector, buckets = key
+        with self._lock:
+            self._entries.append({
+                'scope': scope, 'vector': vector, 'buckets': buckets, 'payload': payload, 'ts': time.time()
+            })
+            if len(self._entries) > self.max_size:
+                del self._entries[:len(self._entries) - self.max_size]
+            self._matrix = None
+
+    @staticmethod
+    def _prices_close(cached: Dict[str, int], current: Dict[str, int]) -> bool:
+        return all(abs(cached.get(symbol, bucket) - bucket) <= 1 for symbol, bucket in current.items())
+
+    def _evict_expired(self):
+        cutoff = time.time() - self.max_age
+        fresh = [entry for entry in self._entries if entry['ts'] >= cutoff]
+        if len(fresh) != len(self._entries):
+            self._entries = fresh
+            self._matrix = None
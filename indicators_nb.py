@@ -0,0 +1,77 @@
+"""
+Indicator kernels - SMA/RSI/pct-change over a daily close array.
+Compiled with numba when it is installed; otherwise falls back to NumPy.
+"""
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # pragma: no cover - optional dependency
+    njit = None
+
+
+def _rsi_sma_loop(prices):
+    """Return (sma5, sma20, rsi14, pct5, pct20) for a float64 price array (len >= 14)"""
+    n = prices.shape[0]
+    last = prices[n - 1]
+
+    sma5 = 0.0
+    for i in range(n - 5, n):
+        sma5 += prices[i]
+    sma5 /= 5.0
+
+    start20 = n - 20 if n > 20 else 0
+    sma20 = 0.0
+    for i in range(start20, n):
+        sma20 += prices[i]
+    sma20 /= n - start20
+
+    # RSI 14：最近14个涨跌幅的简单平均
+    gain = 0.0
+    loss = 0.0
+    start14 = n - 14 if n > 14 else 1
+    for i in range(start14, n):
+        delta = prices[i] - prices[i - 1]
+        if delta > 0:
+            gain += delta
+        else:
+            loss -= delta
+    if loss == 0.0:
+        rsi = 100.0
+    else:
+        rsi = 100.0 - 100.0 / (1.0 + gain / loss)
+
+    base5 = prices[n - 5]
+    pct5 = (last - base5) / base5 * 100.0 if base5 != 0.0 else 0.0
+    pct20 = 0.0
+    if n >= 20:
+        base20 = prices[n - 20]
+        if base20 != 0.0:
+            pct20 = (last - base20) / base20 * 100.0
+    return sma5, sma20, rsi, pct5, pct20
+
+
+def _rsi_sma_numpy(prices):
+    sma5 = prices[-5:].mean()
+    sma20 = prices[-20:].mean()
+
+    changes = np.diff(prices)[-14:]
+    gain = np.clip(changes, 0, None).sum()
+    loss = np.clip(-changes, 0, None).sum()
+    rsi = 100.0 if loss == 0 else 100.0 - 100.0 / (1.0 + gain / loss)
+
+    pct5 = (prices[-1] - prices[-5]) / prices[-5] * 100 if prices[-5] else 0.0
+    pct20 = (prices[-1] - prices[-20]) / prices[-20] * 100 if len(prices) >= 20 and prices[-20] else 0.0
+    return float(sma5), float(sma20), float(rsi), float(pct5), float(pct20)
+
+
+if njit is not None:
+    rsi_sma = njit(cache=True, fastmath=True)(_rsi_sma_loop)
+    try:
+        # 导入时预热，避免首个交易周期承担编译耗时
+        rsi_sma(np.linspace(1.0, 2.0, 20))
+    except Exception as e:  # pragma: no cover
+        print(f'[WARN] numba indicator kernel unavailable, using NumPy: {e}')
+        rsi_sma = _rsi_sma_numpy
+else:
+    rsi_sma = _rsi_sma_numpy
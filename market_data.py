@@ -3,12 +3,22 @@ Market data module - integrates Sina Finance for configurable A-share stocks.
 Original JQData implementation remains commented for future re-enable when needed.
 """
 import os
+import queue
 import time
-import json
+import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, time as dt_time
 from typing import Dict, List, Optional
 
+import numpy as np
+import orjson
 import requests
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+
+from indicators_nb import rsi_sma
 
 # from jqdatasdk import auth, get_price  # 聚宽接口（保留，后续可恢复）
 
@@ -17,20 +27,46 @@ try:
 except ImportError:  # pragma: no cover
     import config_example as app_config
 
+# 新浪行情: var hq_str_sh600519="名称,今开,昨收,现价,...";
+_SINA_RE = re.compile(rb'var hq_str_([a-z]+\d+)="([^"]+)";')
+# 新浪K线JSONP: /*...*/ var=([{...}]);
+_SINA_KLINE_RE = re.compile(r'=\s*\(?\s*(\[.*\])\s*\)?\s*;?\s*$', re.S)
+
 
 class MarketDataFetcher:
     """Fetch real-time market data from Sina Finance for configured stocks"""
 
     def __init__(self, db, jq_username: str = None, jq_password: str = None):
         self.db = db
-        self._cache = {}
-        self._cache_time = {}
         self._cache_duration = getattr(app_config, 'MARKET_API_CACHE', 5)
+        # 按单个标的缓存，不同子集的请求可以共享缓存且内存有上限
+        self._price_cache = TTLCache(maxsize=1024, ttl=self._cache_duration)
+        self._history_cache = TTLCache(maxsize=1024, ttl=getattr(app_config, 'MARKET_HISTORY_CACHE', 300))
+        self._cache_lock = threading.Lock()
         self.session = requests.Session()
         self.session.headers.update({'Referer': 'https://finance.sina.com.cn'})
+        # 连接池需容纳并发抓取K线的线程数
+        self._history_workers = 8
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self._history_workers)
+        self.session.mount('https://', adapter)
+        self._history_executor = ThreadPoolExecutor(max_workers=self._history_workers, thread_name_prefix='sina-history')
         self._last_market_open_state: bool = False
         self._last_live_prices: Dict[str, Dict] = {}
         self._last_live_date: Optional[datetime.date] = None
+        # 每个标的的滚动指标状态（SMA/RSI增量更新）
+        self._indicator_state: Dict[str, Dict] = {}
+        self._indicator_lock = threading.Lock()
+        # 股票配置很少变化，按TTL缓存；配置变更时由管理接口主动失效
+        self._stocks_cache: Optional[List[Dict]] = None
+        self._stocks_cache_ts = 0.0
+        self._stocks_ttl = 60
+        self._stock_map: Dict[str, Dict] = {}
+        self._sina_symbols: Dict[str, str] = {}
+        # 收盘价落库放到后台线程，按约1秒窗口批量写入，避免阻塞行情请求
+        self._persist_window = 1.0
+        self._persist_queue: queue.Queue = queue.Queue()
+        self._persist_thread = threading.Thread(target=self._persist_worker, name='price-persist', daemon=True)
+        self._persist_thread.start()
 
         # 聚宽账号信息（保留，便于未来切换）
         # self.jq_username = jq_username or getattr(app_config, 'JQDATA_USERNAME', None) or os.getenv('JQDATA_USERNAME')
@@ -45,11 +81,31 @@ class MarketDataFetcher:
         #     print('[WARN] JQData credentials not provided. Set JQDATA_USERNAME and JQDATA_PASSWORD.')
 
     def _get_configured_stocks(self) -> List[Dict]:
+        now = time.time()
+        if self._stocks_cache is not None and now - self._stocks_cache_ts < self._stocks_ttl:
+            return self._stocks_cache
+
         stocks = self.db.get_stock_configs()
         if not stocks:
             print('[WARN] No stocks configured. Please add stocks via configuration UI.')
+        self._stock_map = {stock['symbol']: stock for stock in stocks}
+        # 新浪代码前缀在配置不变时固定，随配置缓存一起预先计算
+        self._sina_symbols = {stock['symbol']: self._format_sina_symbol(stock) for stock in stocks}
+        self._stocks_cache = stocks
+        self._stocks_cache_ts = now
         return stocks
 
+    def _get_stock_map(self) -> Dict[str, Dict]:
+        self._get_configured_stocks()
+        return self._stock_map
+
+    def get_configured_symbols(self) -> List[str]:
+        return [stock['symbol'] for stock in self._get_configured_stocks()]
+
+    def invalidate_stocks_cache(self):
+        """Drop cached stock configs after they are changed"""
+        self._stocks_cache = None
+
     def _parse_time_setting(self, value: str) -> dt_time:
         try:
             parts = [int(p) for p in value.split(':')]
@@ -74,7 +130,7 @@ class MarketDataFetcher:
         return now_time >= start_time or now_time <= end_time
 
     def _format_stored_prices(self, stored_prices: Dict[str, Dict], symbols: Optional[List[str]] = None) -> Dict[str, Dict]:
-        stock_map = {stock['symbol']: stock for stock in self._get_configured_stocks()}
+        stock_map = self._get_stock_map()
         target_symbols = symbols or list(stock_map.keys()) or list(stored_prices.keys())
         formatted: Dict[str, Dict] = {}
 
@@ -104,10 +160,28 @@ class MarketDataFetcher:
             price = payload.get('price')
             if price is None:
                 continue
+            self._persist_queue.put((symbol, float(price), price_date))
+
+    def _persist_worker(self):
+        """Drain queued (symbol, price, date) rows and write each batch in one transaction"""
+        while True:
+            row = self._persist_queue.get()
+            batch = {(row[0], row[2]): row}
+            deadline = time.monotonic() + self._persist_window
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    row = self._persist_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                # 同一标的同一天只保留最新价格
+                batch[(row[0], row[2])] = row
             try:
-                self.db.upsert_daily_price(symbol, float(price), price_date)
+                self.db.upsert_daily_prices(list(batch.values()))
             except Exception as err:
-                print(f'[WARN] Failed to persist closing price for {symbol}: {err}')
+                print(f'[WARN] Failed to persist {len(batch)} daily prices: {err}')
 
     def get_prices(self, symbols: Optional[List[str]] = None) -> Dict[str, Dict]:
         """Return prices respecting configured trading hours"""
@@ -132,7 +206,7 @@ class MarketDataFetcher:
         stored_prices = self.db.get_latest_daily_prices(symbols)
         formatted = self._format_stored_prices(stored_prices, symbols)
 
-        target_symbols = symbols or [stock['symbol'] for stock in self._get_configured_stocks()]
+        target_symbols = symbols or self.get_configured_symbols()
         missing_symbols = [sym for sym in target_symbols if sym not in formatted]
 
         if missing_symbols:
@@ -146,10 +220,7 @@ class MarketDataFetcher:
                     payload['price_date'] = price_date
                     formatted[symbol] = payload
                     self._last_live_prices[symbol] = payload.copy()
-                    try:
-                        self.db.upsert_daily_price(symbol, float(payload.get('price', 0)), price_date)
-                    except Exception as err:
-                        print(f'[WARN] Failed to persist fallback price for {symbol}: {err}')
+                    self._persist_queue.put((symbol, float(payload.get('price', 0)), price_date))
                 self._last_live_date = now.date()
 
         # Fallback to most recent live snapshot if still no data
@@ -184,53 +255,63 @@ class MarketDataFetcher:
             return {}
 
         if symbols:
-            stocks = [s for s in stocks if s['symbol'] in symbols]
+            wanted = set(symbols)
+            stocks = [s for s in stocks if s['symbol'] in wanted]
 
         if not stocks:
             return {}
 
-        cache_key = 'prices_' + '_'.join(sorted([s['symbol'] for s in stocks]))
-        if cache_key in self._cache:
-            if time.time() - self._cache_time[cache_key] < self._cache_duration:
-                return self._cache[cache_key]
-
-        sina_symbols = [self._format_sina_symbol(stock) for stock in stocks]
         prices = {}
+        missing = []
+        with self._cache_lock:
+            for stock in stocks:
+                cached = self._price_cache.get(stock['symbol'])
+                if cached is not None:
+                    prices[stock['symbol']] = dict(cached)
+                else:
+                    missing.append(stock)
+        if not missing:
+            return prices
+        requested, stocks = stocks, missing
+
+        sina_map = self._sina_symbols
+        sina_symbols = [sina_map.get(stock['symbol']) or self._format_sina_symbol(stock) for stock in stocks]
+        stock_by_sina = dict(zip(sina_symbols, stocks))
+        fetched = {}
 
         try:
             url = 'https://hq.sinajs.cn/list=' + ','.join(sina_symbols)
             resp = self.session.get(url, timeout=5)
-            resp.encoding = 'gbk'
-            lines = resp.text.strip().split('\n')
-            for line, stock in zip(lines, stocks):
-                parts = line.split('=')
-                if len(parts) != 2 or not parts[1].strip().strip(';').strip('"'):
-                    continue
-                data_str = parts[1].strip().strip(';')
-                data_str = data_str.strip('"')
-                fields = data_str.split(',')
-                if len(fields) < 4:
+            # 数值字段都是ASCII，直接在原始字节上匹配，只对名称字段做gbk解码
+            # 名称以新浪实时返回为准（含 ST/*ST/退 等风险前缀），为空时才用配置值
+            for match in _SINA_RE.finditer(resp.content):
+                stock = stock_by_sina.get(match.group(1).decode('ascii'))
+                fields = match.group(2).split(b',')
+                if stock is None or len(fields) < 4:
                     continue
                 try:
-                    price = float(fields[3])
-                    prev_close = float(fields[2]) if fields[2] else 0
+                    prev_close, price = map(float, (fields[2] or b'0', fields[3]))
                 except ValueError:
                     price = 0
                     prev_close = 0
                 change_pct = ((price - prev_close) / prev_close * 100) if prev_close else 0
-                prices[stock['symbol']] = {
+                fetched[stock['symbol']] = {
                     'price': price,
-                    'name': fields[0] or stock['name'],
+                    'name': fields[0].decode('gbk', errors='replace') or stock['name'],
                     'exchange': stock['exchange'],
                     'change_24h': change_pct
                 }
 
-            self._cache[cache_key] = prices
-            self._cache_time[cache_key] = time.time()
-            return prices
+            with self._cache_lock:
+                for symbol, payload in fetched.items():
+                    self._price_cache[symbol] = payload
+                    prices[symbol] = dict(payload)
+            return {stock['symbol']: prices[stock['symbol']] for stock in requested if stock['symbol'] in prices}
         except Exception as e:
             print(f'[ERROR] Sina price fetch failed: {e}')
-            return {stock['symbol']: {'price': 0, 'name': stock['name'], 'exchange': stock['exchange']} for stock in stocks}
+            for stock in stocks:
+                prices[stock['symbol']] = {'price': 0, 'name': stock['name'], 'exchange': stock['exchange']}
+            return {stock['symbol']: prices[stock['symbol']] for stock in requested}
 
         # ====== JQData 实现保留 ======
         # try:
@@ -239,7 +320,7 @@ class MarketDataFetcher:
         #     print(f'[ERROR] JQData price fetch failed: {e}')
 
     def get_market_data(self, symbol: str) -> Dict:
-        stocks = {stock['symbol']: stock for stock in self._get_configured_stocks()}
+        stocks = self._get_stock_map()
         if symbol not in stocks:
             return {}
         api_symbol = stocks[symbol]['api_symbol']
@@ -258,82 +339,184 @@ class MarketDataFetcher:
             print(f'[ERROR] Failed to get market data for {symbol}: {e}')
             return {}
 
+    @staticmethod
+    def _strip_sina_jsonp(text: str) -> str:
+        """Fallback JSONP unwrapping when _SINA_KLINE_RE does not match"""
+        text = text.strip()
+
+        # Sina JSONP responses sometimes have "var=" and trailing semicolons or comments
+        if text.endswith(';'):
+            text = text[:-1]
+        while text.startswith('/*'):
+            end_comment = text.find('*/')
+            if end_comment == -1:
+                break
+            text = text[end_comment + 2:].lstrip()
+        if '=' in text:
+            text = text.split('=', 1)[1].strip()
+        if text.startswith('(') and text.endswith(')'):
+            text = text[1:-1].strip()
+        return text
+
     def get_historical_prices(self, symbol: str, count: int = 60) -> List[Dict]:
-        stocks = {stock['symbol']: stock for stock in self._get_configured_stocks()}
+        stocks = self._get_stock_map()
         if symbol not in stocks:
             return []
         api_symbol = stocks[symbol]['api_symbol']
 
+        cache_key = (symbol, count)
+        with self._cache_lock:
+            cached = self._history_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
         try:
-            sina_symbol = self._format_sina_symbol({'symbol': symbol, 'exchange': stocks[symbol]['exchange']})
+            sina_symbol = self._sina_symbols.get(symbol) or self._format_sina_symbol(stocks[symbol])
             url = (
                 'https://quotes.sina.cn/cn/api/jsonp_v2.php/var=/CN_MarketDataService.getKLineData'
                 f'?symbol={sina_symbol}&scale=240&ma=no&datalen={count}'
             )
             resp = self.session.get(url, timeout=5)
-            text = resp.text.strip()
-
-            # Sina JSONP responses sometimes have "var=" and trailing semicolons or comments
-            if text.endswith(';'):
-                text = text[:-1]
-            while text.startswith('/*'):
-                end_comment = text.find('*/')
-                if end_comment == -1:
-                    break
-                text = text[end_comment + 2:].lstrip()
-            if '=' in text:
-                text = text.split('=', 1)[1].strip()
-            if text.startswith('(') and text.endswith(')'):
-                text = text[1:-1].strip()
+            match = _SINA_KLINE_RE.search(resp.text)
+            text = match.group(1) if match else self._strip_sina_jsonp(resp.text)
 
             if not text or text in ('null', '[]'):  # invalid/empty payload
                 raise ValueError('Empty historical data payload')
 
-            data = json.loads(text)
-            return [
+            data = orjson.loads(text)
+            history = [
                 {'timestamp': item['day'], 'price': float(item['close'])}
                 for item in data if 'close' in item and item.get('day')
             ]
-        except json.JSONDecodeError as e:
+            if history:
+                with self._cache_lock:
+                    self._history_cache[cache_key] = history
+            return history
+        except orjson.JSONDecodeError as e:
             print(f'[ERROR] Failed to parse historical prices for {symbol}: {e} | payload={resp.text[:120]}')
             return []
         except Exception as e:
             print(f'[ERROR] Failed to get historical prices for {symbol}: {e}')
             return []
 
+    def get_historical_prices_many(self, symbols: List[str], count: int = 60) -> Dict[str, List[Dict]]:
+        """Fetch historical prices for several symbols concurrently (I/O bound)"""
+        if len(symbols) <= 1:
+            return {symbol: self.get_historical_prices(symbol, count) for symbol in symbols}
+        results = self._history_executor.map(lambda symbol: self.get_historical_prices(symbol, count), symbols)
+        return dict(zip(symbols, results))
+
     def calculate_technical_indicators(self, symbol: str) -> Dict:
-        history = self.get_historical_prices(symbol, count=60)
-        if not history:
-            return {}
+        """Single-symbol convenience wrapper around calculate_technical_indicators_batch"""
+        return self.calculate_technical_indicators_batch([symbol])[symbol]
 
-        prices = [item['price'] for item in history]
-        if len(prices) < 14:
-            return {}
+    def _compute_indicators(self, prices: np.ndarray) -> Dict:
+        """Full recomputation from a price array (used to seed the rolling state)"""
+        sma_5, sma_20, rsi, pct_change_5, pct_change_20 = rsi_sma(np.ascontiguousarray(prices, dtype=np.float64))
 
-        sma_5 = sum(prices[-5:]) / 5
-        sma_20 = sum(prices[-20:]) / 20 if len(prices) >= 20 else sum(prices) / len(prices)
+        return {
+            'sma_5': float(sma_5),
+            'sma_20': float(sma_20),
+            'rsi_14': float(rsi),
+            'change_5d': float(pct_change_5),
+            'change_20d': float(pct_change_20),
+            'current_price': float(prices[-1])
+        }
 
-        # RSI 14
-        changes = [prices[i] - prices[i - 1] for i in range(1, len(prices))]
-        gains = [change if change > 0 else 0 for change in changes]
-        losses = [-change if change < 0 else 0 for change in changes]
-        avg_gain = sum(gains[-14:]) / 14
-        avg_loss = sum(losses[-14:]) / 14
-        if avg_loss == 0:
+    def calculate_technical_indicators_batch(self, symbols: List[str]) -> Dict[str, Dict]:
+        """Indicators for many symbols: one concurrent K-line fetch, then a rolling update or a kernel reseed each"""
+        histories = self.get_historical_prices_many(symbols)
+        results: Dict[str, Dict] = {}
+
+        with self._indicator_lock:
+            for symbol in symbols:
+                history = histories.get(symbol)
+                if not history or len(history) < 14:
+                    self._indicator_state.pop(symbol, None)
+                    results[symbol] = {}
+                    continue
+                state = self._indicator_state.get(symbol)
+                if state is not None and self._update_indicator_state(state, history):
+                    results[symbol] = state['indicators']
+                else:
+                    results[symbol] = self._seed_indicator_state(symbol, history)
+
+        return results
+
+    def _seed_indicator_state(self, symbol: str, history: List[Dict]) -> Dict:
+        prices = np.fromiter((item['price'] for item in history), dtype=np.float64, count=len(history))
+        indicators = self._compute_indicators(prices)
+        self._store_indicator_state(symbol, history[-1]['timestamp'], prices[-20:], np.diff(prices)[-14:], indicators)
+        return indicators
+
+    def _store_indicator_state(self, symbol: str, last_day, tail: np.ndarray, changes: np.ndarray, indicators: Dict):
+        self._indicator_state[symbol] = {
+            'last_day': last_day,
+            'last_prices': deque(tail.tolist(), maxlen=20),
+            'deltas': deque(changes.tolist(), maxlen=14),
+            'sma5_sum': float(tail[-5:].sum()),
+            'sma20_sum': float(tail.sum()),
+            'gain_sum': float(np.clip(changes, 0, None).sum()),
+            'loss_sum': float(np.clip(-changes, 0, None).sum()),
+            'indicators': indicators
+        }
+
+    def _update_indicator_state(self, state: Dict, history: List[Dict]) -> bool:
+        """O(1) update of the rolling sums; returns False when the state must be reseeded"""
+        last_prices = state['last_prices']
+        deltas = state['deltas']
+        day = history[-1]['timestamp']
+        price = float(history[-1]['price'])
+
+        if day == state['last_day']:
+            if float(history[-2]['price']) != last_prices[-2]:
+                return False
+            # 当日K线仍在变动：替换最后一个价格
+            old_price = last_prices[-1]
+            if price == old_price:
+                return True
+            last_prices[-1] = price
+            state['sma5_sum'] += price - old_price
+            state['sma20_sum'] += price - old_price
+            old_delta = deltas[-1]
+            state['gain_sum'] -= max(old_delta, 0.0)
+            state['loss_sum'] -= max(-old_delta, 0.0)
+            delta = price - last_prices[-2]
+            deltas[-1] = delta
+        elif history[-2]['timestamp'] == state['last_day'] and float(history[-2]['price']) == last_prices[-1]:
+            # 新的一根K线
+            delta = price - last_prices[-1]
+            state['sma5_sum'] += price - last_prices[-5]
+            state['sma20_sum'] += price - (last_prices[0] if len(last_prices) == last_prices.maxlen else 0.0)
+            last_prices.append(price)
+            if len(deltas) == deltas.maxlen:
+                state['gain_sum'] -= max(deltas[0], 0.0)
+                state['loss_sum'] -= max(-deltas[0], 0.0)
+            deltas.append(delta)
+            state['last_day'] = day
+        else:
+            return False
+
+        state['gain_sum'] += max(delta, 0.0)
+        state['loss_sum'] += max(-delta, 0.0)
+
+        count = len(last_prices)
+        avg_gain = state['gain_sum'] / 14
+        avg_loss = state['loss_sum'] / 14
+        if avg_loss <= 1e-12:
             rsi = 100
         else:
             rs = avg_gain / avg_loss
             rsi = 100 - (100 / (1 + rs))
 
-        pct_change_5 = ((prices[-1] - prices[-5]) / prices[-5]) * 100 if prices[-5] else 0
-        pct_change_20 = ((prices[-1] - prices[-20]) / prices[-20]) * 100 if len(prices) >= 20 and prices[-20] else 0
-
-        return {
-            'sma_5': sma_5,
-            'sma_20': sma_20,
-            'rsi_14': rsi,
-            'change_5d': pct_change_5,
-            'change_20d': pct_change_20,
-            'current_price': prices[-1]
+        price_5 = last_prices[-5]
+        price_20 = last_prices[0]
+        state['indicators'] = {
+            'sma_5': state['sma5_sum'] / 5,
+            'sma_20': state['sma20_sum'] / count,
+            'rsi_14': float(rsi),
+            'change_5d': ((price - price_5) / price_5) * 100 if price_5 else 0,
+            'change_20d': ((price - price_20) / price_20) * 100 if count >= 20 and price_20 else 0,
+            'current_price': price
         }
-
+        return True
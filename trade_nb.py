@@ -0,0 +1,66 @@
+"""
+Trade arithmetic kernels - fee, margin and P&L for a single fill or a batch.
+Compiled with numba when it is installed; otherwise falls back to Python/NumPy.
+"""
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:  # pragma: no cover - optional dependency
+    njit = None
+    prange = range
+
+SIDE_LONG = 1.0
+SIDE_SHORT = -1.0
+
+
+def _compute_trade(qty, price, fee_rate, leverage, entry_price, side):
+    """Return (trade_fee, required_margin, gross_pnl, net_pnl); side is 1.0 long / -1.0 short"""
+    trade_fee = qty * price * fee_rate  # 按成交额计算手续费
+    required_margin = qty * price / leverage
+    gross_pnl = (price - entry_price) * side * qty  # 平仓毛利；开仓时 entry_price 取成交价即为0
+    net_pnl = gross_pnl - trade_fee
+    return trade_fee, required_margin, gross_pnl, net_pnl
+
+
+def _compute_trades_loop(qty, price, fee_rate, leverage, entry_price, side):
+    n = qty.shape[0]
+    out = np.empty((n, 4), dtype=np.float64)
+    for i in prange(n):
+        trade_fee = qty[i] * price[i] * fee_rate
+        gross_pnl = (price[i] - entry_price[i]) * side[i] * qty[i]
+        out[i, 0] = trade_fee
+        out[i, 1] = qty[i] * price[i] / leverage[i]
+        out[i, 2] = gross_pnl
+        out[i, 3] = gross_pnl - trade_fee
+    return out
+
+
+def _compute_trades_numpy(qty, price, fee_rate, leverage, entry_price, side):
+    trade_fee = qty * price * fee_rate
+    gross_pnl = (price - entry_price) * side * qty
+    return np.column_stack((trade_fee, qty * price / leverage, gross_pnl, gross_pnl - trade_fee))
+
+
+def compute_trades_batch(qty, price, fee_rate, leverage, entry_price, side):
+    """Vectorized compute_trade over float64 arrays; returns an [N, 4] array in the same column order"""
+    arrays = [np.ascontiguousarray(a, dtype=np.float64) for a in (qty, price, leverage, entry_price, side)]
+    qty, price, leverage, entry_price, side = arrays
+    return _compute_trades_batch(qty, price, float(fee_rate), leverage, entry_price, side)
+
+
+if njit is not None:
+    # 不开 fastmath，保证手续费与盈亏和纯Python计算逐位一致
+    compute_trade = njit(cache=True)(_compute_trade)
+    _compute_trades_batch = njit(cache=True, parallel=True)(_compute_trades_loop)
+    try:
+        # 导入时预热，避免首笔成交承担编译耗时
+        compute_trade(1.0, 1.0, 0.001, 1.0, 1.0, SIDE_LONG)
+        _compute_trades_batch(np.ones(1), np.ones(1), 0.001, np.ones(1), np.ones(1), np.ones(1))
+    except Exception as e:  # pragma: no cover
+        print(f'[WARN] numba trade kernel unavailable, using Python: {e}')
+        compute_trade = _compute_trade
+        _compute_trades_batch = _compute_trades_numpy
+else:
+    compute_trade = _compute_trade
+    _compute_trades_batch = _compute_trades_numpy
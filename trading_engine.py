@@ -1,6 +1,51 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Dict
-import json
+from typing import Dict, List, NamedTuple, Optional, Set
+import logging
+import time
+
+import numpy as np
+import orjson
+
+from trade_nb import SIDE_LONG, SIDE_SHORT, compute_trade
+
+logger = logging.getLogger(__name__)
+
+try:
+    import config as app_config
+except ImportError:  # pragma: no cover
+    import config_example as app_config
+
+# 行情快照与K线指标互不依赖，并行获取；各引擎共享，线程数上限8
+_market_state_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='market-state')
+
+class TradeResult(NamedTuple):
+    """Outcome of one decision; converted to a dict only at the API boundary"""
+    coin: str
+    signal: Optional[str] = None
+    quantity: Optional[float] = None
+    price: Optional[float] = None
+    leverage: Optional[int] = None
+    pnl: Optional[float] = None
+    fee: Optional[float] = None
+    message: Optional[str] = None
+    error: Optional[str] = None
+
+    def to_dict(self) -> Dict:
+        return {key: value for key, value in zip(self._fields, self) if value is not None}
+
+
+@dataclass
+class CycleCtx:
+    """Per-cycle execution state shared by the signal handlers"""
+    tracked: frozenset
+    positions_map: Dict
+    existing_symbols: Set[str]
+    cash: float
+    fee_multiplier: float
+    buy_sizes: Dict = field(default_factory=dict)
+
 
 class TradingEngine:
     def __init__(self, model_id: int, db, market_fetcher, ai_trader, trade_fee_rate: float = 0.001):
@@ -9,12 +54,49 @@ class TradingEngine:
         self.market_fetcher = market_fetcher
         self.ai_trader = ai_trader
         self.trade_fee_rate = trade_fee_rate  # 从配置中传入费率
+        self._fee_multiplier = 1.0 + trade_fee_rate  # 含手续费的单股成本系数
+        # 无成交时仅在账户总值漂移超过阈值后才写入快照
+        self._value_drift = getattr(app_config, 'ACCOUNT_VALUE_DRIFT', 0.001)
+        self._last_recorded_value: Optional[float] = None
+        self._traceback_interval = 10.0
+        # 空闲闸门：行情与持仓相对上次AI调用无明显变化时跳过LLM
+        self._idle_gate_enabled = getattr(app_config, 'AI_IDLE_GATE_ENABLED', True)
+        self._idle_drift = getattr(app_config, 'AI_IDLE_PRICE_DRIFT', 0.005)
+        self._idle_max_skips = getattr(app_config, 'AI_IDLE_MAX_SKIPS', 5)
+        self._idle_skips = 0
+        self._last_ai_state: Optional[Dict] = None
+        self._record_hold_conversations = getattr(app_config, 'RECORD_HOLD_CONVERSATIONS', False)
+        self._last_traceback_at = float('-inf')
         self.max_positions = 3
+        # 信号分发表（AITrader 解析时已统一转为小写）
+        self._signal_handlers = {
+            'buy_to_enter': self._handle_buy,
+            'close_position': self._handle_close,
+            'hold': self._handle_hold,
+            'sell_to_enter': self._handle_sell_unsupported,
+        }
+        # 初始资金在模型生命周期内不变，只在创建时读取一次
+        self._initial_capital = None
+        self._inv_initial_capital_pct = None
+        self.refresh_model()
+        # 跟踪标的在股票配置变更时由 reload_symbols() 刷新，交易周期内直接复用
+        self._tracked_symbols: List[str] = []
+        self._tracked_symbols_set: frozenset = frozenset()
+        self.reload_symbols()
+
+    def refresh_model(self):
+        """Reload cached model fields (initial capital) from the database"""
+        self._initial_capital = self.db.get_model(self.model_id)['initial_capital']
+        self._inv_initial_capital_pct = 100.0 / self._initial_capital if self._initial_capital else 0.0
 
-    def _get_tracked_symbols(self):
-        return [stock['symbol'] for stock in self.db.get_stock_configs()]
+    def reload_symbols(self):
+        """Refresh the tracked symbols; call after stock configs change"""
+        symbols = self.market_fetcher.get_configured_symbols()
+        self._tracked_symbols = symbols
+        self._tracked_symbols_set = frozenset(symbols)
     
-    def execute_trading_cycle(self) -> Dict:
+    def execute_trading_cycle(self, use_idle_gate: bool = True) -> Dict:
+        """Run one decision/execution cycle; use_idle_gate=False always asks the AI (manual runs)"""
         try:
             if not self.market_fetcher.is_within_trading_window():
                 return {
@@ -23,7 +105,9 @@ class TradingEngine:
                     'skipped': True
                 }
 
-            market_state = self._get_market_state()
+            symbols = self._tracked_symbols
+            tracked = self._tracked_symbols_set
+            market_state = self._get_market_state(symbols)
             
             current_prices = {symbol: market_state[symbol]['price'] for symbol in market_state}
             
@@ -31,79 +115,223 @@ class TradingEngine:
             
             account_info = self._build_account_info(portfolio)
             
-            decision_payload = self.ai_trader.make_decision(
-                market_state, portfolio, account_info
-            )
+            ai_called = not use_idle_gate or self._should_call_ai(market_state, portfolio)
+            if ai_called:
+                decision_payload = self.ai_trader.make_decision(
+                    market_state, portfolio, account_info
+                )
+            else:
+                # 行情平静：跳过LLM调用，全部观望
+                self._idle_skips += 1
+                decision_payload = {'decisions': {
+                    symbol: {'signal': 'hold', 'justification': '行情无明显变化，未调用AI'} for symbol in market_state
+                }}
 
             decisions = decision_payload.get('decisions') or {}
             if not isinstance(decisions, dict):
                 decisions = {}
 
-            prompt = decision_payload.get('prompt')
-            if not prompt:
-                prompt = self._format_prompt(market_state, portfolio, account_info)
-
-            raw_response = decision_payload.get('raw_response')
-            if not isinstance(raw_response, str):
-                raw_response = json.dumps(decisions, ensure_ascii=False)
-            cot_trace = decision_payload.get('cot_trace') or ''
-
-            self.db.add_conversation(
-                self.model_id,
-                user_prompt=prompt,
-                ai_response=raw_response,
-                cot_trace=cot_trace
-            )
+            # 对话、成交、持仓与账户快照在同一事务中提交，每个周期只落盘一次
+            with self.db.transaction():
+                # 全部观望的周期默认不落对话记录
+                if ai_called and (self._record_hold_conversations or not self._is_hold_only(decisions)):
+                    self._record_conversation(decision_payload, decisions, market_state, portfolio, account_info)
             
-            execution_results = self._execute_decisions(decisions, market_state, portfolio)
+                ctx = CycleCtx(
+                    tracked=tracked,
+                    positions_map={pos['coin']: pos for pos in portfolio.get('positions', [])},
+                    existing_symbols={pos['coin'] for pos in portfolio.get('positions', [])},
+                    cash=portfolio['cash'],
+                    fee_multiplier=self._fee_multiplier
+                )
+                execution_results = self._execute_decisions(ctx, decisions, market_state)
             
-            updated_portfolio = self.db.get_portfolio(self.model_id, current_prices)
-            self.db.record_account_value(
-                self.model_id,
-                updated_portfolio['total_value'],
-                updated_portfolio['cash'],
-                updated_portfolio['positions_value']
-            )
+                updated_portfolio = self._apply_executions(
+                    portfolio, execution_results, current_prices, account_info['initial_capital']
+                )
+                total_value = updated_portfolio['total_value']
+                record_value = self._should_record_value(execution_results, total_value)
+                if record_value:
+                    self.db.record_account_value(
+                        self.model_id,
+                        total_value,
+                        updated_portfolio['cash'],
+                        updated_portfolio['positions_value']
+                    )
+            if record_value:
+                self._last_recorded_value = total_value
+            if ai_called and decisions:
+                # 以成交后的持仓作为下次闸门比较的基准
+                self._remember_ai_state(market_state, updated_portfolio, decisions)
             
             return {
                 'success': True,
                 'decisions': decisions,
-                'executions': execution_results,
-                'portfolio': updated_portfolio
+                'executions': [result.to_dict() for result in execution_results],
+                'portfolio': updated_portfolio,
+                'ai_skipped': not ai_called
             }
             
         except Exception as e:
-            print(f"[ERROR] Trading cycle failed (Model {self.model_id}): {e}")
-            import traceback
-            print(traceback.format_exc())
+            # 上游故障时可能连续失败：每个模型每10秒最多输出一次完整堆栈
+            now = time.monotonic()
+            if now - self._last_traceback_at >= self._traceback_interval:
+                self._last_traceback_at = now
+                logger.exception("[ERROR] Trading cycle failed (Model %s): %s", self.model_id, e)
+            else:
+                logger.error("[ERROR] Trading cycle failed (Model %s): %s", self.model_id, e)
             return {
                 'success': False,
                 'error': str(e)
             }
     
-    def _get_market_state(self) -> Dict:
+    def _record_conversation(self, decision_payload: Dict, decisions: Dict, market_state: Dict,
+                             portfolio: Dict, account_info: Dict):
+        prompt = decision_payload.get('prompt')
+        if not prompt:
+            prompt = self._format_prompt(market_state, portfolio, account_info)
+
+        raw_response = decision_payload.get('raw_response')
+        if not isinstance(raw_response, str):
+            raw_response = orjson.dumps(decisions).decode('utf-8')
+        cot_trace = decision_payload.get('cot_trace') or ''
+
+        self.db.add_conversation(
+            self.model_id,
+            user_prompt=prompt,
+            ai_response=raw_response,
+            cot_trace=cot_trace
+        )
+    
+    @staticmethod
+    def _is_hold_only(decisions: Dict) -> bool:
+        # 空决策（解析失败）仍需记录，便于排查
+        return bool(decisions) and all(
+            isinstance(decision, dict) and decision.get('signal') == 'hold'
+            for decision in decisions.values()
+        )
+    
+    @staticmethod
+    def _rsi_zone(data: Dict) -> int:
+        rsi = (data.get('indicators') or {}).get('rsi_14')
+        if rsi is None:
+            return 0
+        return -1 if rsi < 30 else (1 if rsi > 70 else 0)
+    
+    @staticmethod
+    def _positions_key(portfolio: Dict) -> frozenset:
+        return frozenset((pos['coin'], pos['side'], pos['quantity']) for pos in portfolio['positions'])
+    
+    @staticmethod
+    def _as_float(value) -> Optional[float]:
+        try:
+            return float(value) if value is not None else None
+        except (TypeError, ValueError):
+            return None
+    
+    def _should_call_ai(self, market_state: Dict, portfolio: Dict) -> bool:
+        """Cheap pre-filter: only ask the LLM when something moved since its last call"""
+        last = self._last_ai_state
+        if not self._idle_gate_enabled or last is None or self._idle_skips >= self._idle_max_skips:
+            return True
+        if market_state.keys() != last['prices'].keys() or self._positions_key(portfolio) != last['positions']:
+            return True
+        
+        for symbol, data in market_state.items():
+            price = data.get('price') or 0
+            last_price = last['prices'][symbol]
+            # 价格漂移超出阈值，或RSI穿越30/70
+            if not last_price or abs(price - last_price) > last_price * self._idle_drift:
+                return True
+            if self._rsi_zone(data) != last['rsi_zones'][symbol]:
+                return True
+        
+        # 持仓自上次AI调用以来新穿越止损/止盈价；已在价位之外被问过的不再重复触发
+        for pos in portfolio['positions']:
+            price = market_state.get(pos['coin'], {}).get('price')
+            decision = last['decisions'].get(pos['coin'])
+            if not price or not isinstance(decision, dict):
+                continue
+            last_price = last['prices'][pos['coin']]
+            stop_loss = self._as_float(decision.get('stop_loss'))
+            profit_target = self._as_float(decision.get('profit_target'))
+            if (stop_loss and last_price > stop_loss >= price) or (profit_target and last_price < profit_target <= price):
+                return True
+        return False
+    
+    def _remember_ai_state(self, market_state: Dict, portfolio: Dict, decisions: Dict):
+        # 止损/止盈价需跨周期保留：模型未再给出时沿用上一次的决策
+        previous = self._last_ai_state['decisions'] if self._last_ai_state else {}
+        self._last_ai_state = {
+            'prices': {symbol: data.get('price') or 0 for symbol, data in market_state.items()},
+            'rsi_zones': {symbol: self._rsi_zone(data) for symbol, data in market_state.items()},
+            'positions': self._positions_key(portfolio),
+            'decisions': {**previous, **{
+                symbol: decision for symbol, decision in decisions.items()
+                if isinstance(decision, dict) and decision.get('signal') == 'buy_to_enter'
+            }}
+        }
+        self._idle_skips = 0
+    
+    def _should_record_value(self, execution_results: List[TradeResult], total_value: float) -> bool:
+        traded = any(result.signal in ('buy_to_enter', 'close_position') for result in execution_results)
+        if traded or self._last_recorded_value is None:
+            return True
+        last = self._last_recorded_value
+        return abs(total_value - last) > abs(last) * self._value_drift
+    
+    def _apply_executions(self, portfolio: Dict, execution_results: List[TradeResult], current_prices: Dict,
+                          initial_capital: float) -> Dict:
+        """Apply executed trades to a copy of the portfolio instead of re-reading it from the DB.
+
+        Mirrors the DB writes: buys replace the long position row, closes delete it and
+        add the trade's net P&L to realized P&L.
+        """
+        positions = {(pos['coin'], pos['side']): dict(pos) for pos in portfolio['positions']}
+        realized_pnl = float(portfolio['realized_pnl'])
+        
+        for result in execution_results:
+            if result.error is not None:
+                continue
+            signal = result.signal
+            coin = result.coin
+            if signal == 'buy_to_enter':
+                key = (coin, 'long')
+                position = positions.get(key) or {'model_id': self.model_id, 'coin': coin, 'side': 'long'}
+                position.update(quantity=float(result.quantity), avg_price=result.price, leverage=result.leverage)
+                positions[key] = position
+            elif signal == 'close_position':
+                key = next((key for key in positions if key[0] == coin), None)
+                positions.pop(key, None)
+                realized_pnl += result.pnl
+        
+        # 与数据库查询结果保持一致的顺序（唯一索引 model_id, coin, side）
+        ordered = [positions[key] for key in sorted(positions)]
+        return self.db.summarize_portfolio(
+            self.model_id, ordered, initial_capital, realized_pnl, current_prices
+        )
+    
+    def _get_market_state(self, symbols: List[str]) -> Dict:
         market_state = {}
-        symbols = self._get_tracked_symbols()
+        indicators_future = _market_state_pool.submit(self.market_fetcher.calculate_technical_indicators_batch, symbols)
         prices = self.market_fetcher.get_prices(symbols)
+        indicators_by_symbol = indicators_future.result()
         
         for symbol in symbols:
             price_info = prices.get(symbol)
             if price_info:
-                market_state[symbol] = price_info.copy()
-                indicators = self.market_fetcher.calculate_technical_indicators(symbol)
-                market_state[symbol]['indicators'] = indicators
+                # get_prices 返回的字典也被行情模块保留为最近快照，不能原地修改
+                market_state[symbol] = {**price_info, 'indicators': indicators_by_symbol.get(symbol, {})}
 
         return market_state
     
     def _build_account_info(self, portfolio: Dict) -> Dict:
-        model = self.db.get_model(self.model_id)
-        initial_capital = model['initial_capital']
-        total_value = portfolio['total_value']
-        total_return = ((total_value - initial_capital) / initial_capital) * 100
+        initial_capital = self._initial_capital
         
         return {
-            'current_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'total_return': total_return,
+            # 保留 datetime，由使用方按需格式化
+            'current_time': datetime.now(),
+            'total_return': (portfolio['total_value'] - initial_capital) * self._inv_initial_capital_pct,
             'initial_capital': initial_capital
         }
     
@@ -111,72 +339,101 @@ class TradingEngine:
                       account_info: Dict) -> str:
         return f"Market State: {len(market_state)} stocks, Portfolio: {len(portfolio['positions'])} positions"
     
-    def _execute_decisions(self, decisions: Dict, market_state: Dict, 
-                          portfolio: Dict) -> list:
+    def _execute_decisions(self, ctx: CycleCtx, decisions: Dict, market_state: Dict) -> List[TradeResult]:
         results = []
-        
-        tracked = set(self._get_tracked_symbols())
-        positions_map = {pos['coin']: pos for pos in portfolio.get('positions', [])}
+        # 按周期初现金批量定量；实际成交时再按 ctx.cash 的最新余额校验
+        ctx.buy_sizes = self._size_buys(decisions, market_state, ctx.cash, ctx.fee_multiplier, ctx.tracked)
 
         for symbol, decision in decisions.items():
-            if symbol not in tracked:
+            if symbol not in ctx.tracked:
                 continue
             
-            signal = decision.get('signal', '').lower()
-            
             try:
-                if signal == 'buy_to_enter':
-                    result = self._execute_buy(symbol, decision, market_state, portfolio)
-                elif signal == 'sell_to_enter':
-                    result = {'coin': symbol, 'error': 'A股账户暂不支持做空'}
-                elif signal == 'close_position':
-                    if symbol not in positions_map:
-                        result = {'coin': symbol, 'error': 'No position to close'}
-                    else:
-                        result = self._execute_close(symbol, decision, market_state, portfolio)
-                elif signal == 'hold':
-                    result = {'coin': symbol, 'signal': 'hold', 'message': '保持观望'}
+                handler = self._signal_handlers.get(decision.get('signal', ''))
+                if handler is None:
+                    result = TradeResult(symbol, error=f"Unknown signal: {decision.get('signal', '')}")
                 else:
-                    result = {'coin': symbol, 'error': f'Unknown signal: {signal}'}
+                    result = handler(ctx, symbol, decision, market_state)
                 
                 results.append(result)
                 
             except Exception as e:
-                results.append({'coin': symbol, 'error': str(e)})
+                results.append(TradeResult(symbol, error=str(e)))
         
         return results
     
-    def _execute_buy(self, symbol: str, decision: Dict, market_state: Dict, 
-                    portfolio: Dict) -> Dict:
-        quantity = decision.get('quantity', 0)
+    def _size_buys(self, decisions: Dict, market_state: Dict, cash: float, fee_multiplier: float,
+                   tracked: frozenset) -> Dict:
+        """Size every buy of the cycle in one vectorized pass: {symbol: quantity or error TradeResult}"""
+        sizes: Dict = {}
+        symbols, prices, requested, risks = [], [], [], []
+        for symbol, decision in decisions.items():
+            if symbol not in tracked or decision.get('signal') != 'buy_to_enter':
+                continue
+            price = (market_state.get(symbol) or {}).get('price')
+            if not price or price <= 0:
+                sizes[symbol] = TradeResult(symbol, error='价格无效')
+                continue
+            try:
+                requested_qty = int(decision.get('quantity', 0))
+                risk_pct = float(decision.get('risk_budget_pct', 3)) / 100
+            except (TypeError, ValueError, OverflowError) as e:
+                sizes[symbol] = TradeResult(symbol, error=f'决策参数无效: {e}')
+                continue
+            symbols.append(symbol)
+            prices.append(price)
+            # 非正数量改用风险预算定量，超过可买数量时本就会被替换：两端截断以免溢出int64
+            requested.append(max(0, min(requested_qty, 2 ** 62)))
+            risks.append(risk_pct)
+        
+        if symbols:
+            effective_price = np.array(prices, dtype=np.float64) * fee_multiplier
+            max_affordable_qty = (cash / effective_price).astype(np.int64)
+            risk_based_qty = (cash * np.clip(np.array(risks, dtype=np.float64), 0.01, 0.05) / effective_price).astype(np.int64)
+            requested_qty = np.array(requested, dtype=np.int64)
+            fallback_qty = np.minimum(max_affordable_qty, np.where(risk_based_qty > 0, risk_based_qty, max_affordable_qty))
+            quantities = np.where((requested_qty > 0) & (requested_qty <= max_affordable_qty), requested_qty, fallback_qty)
+            sizes.update(zip(symbols, quantities.tolist()))
+        return sizes
+    
+    def _handle_buy(self, ctx: CycleCtx, symbol: str, decision: Dict, market_state: Dict) -> TradeResult:
+        return self._execute_buy(ctx, symbol, decision, market_state)
+    
+    def _handle_close(self, ctx: CycleCtx, symbol: str, decision: Dict, market_state: Dict) -> TradeResult:
+        if symbol not in ctx.positions_map:
+            return TradeResult(symbol, error='No position to close')
+        return self._execute_close(ctx, symbol, decision, market_state)
+    
+    def _handle_hold(self, ctx: CycleCtx, symbol: str, *args) -> TradeResult:
+        return TradeResult(symbol, signal='hold', message='保持观望')
+    
+    def _handle_sell_unsupported(self, ctx: CycleCtx, symbol: str, *args) -> TradeResult:
+        return TradeResult(symbol, error='A股账户暂不支持做空')
+    
+    def _execute_buy(self, ctx: CycleCtx, symbol: str, decision: Dict, market_state: Dict) -> TradeResult:
         leverage = int(decision.get('leverage', 1))
         price = market_state[symbol]['price']
         
-        positions = portfolio.get('positions', [])
-        existing_symbols = {pos['coin'] for pos in positions}
-        if symbol not in existing_symbols and len(existing_symbols) >= self.max_positions:
-            return {'coin': symbol, 'error': '达到最大持仓数量，无法继续开仓'}
+        if symbol not in ctx.existing_symbols and len(ctx.existing_symbols) >= self.max_positions:
+            return TradeResult(symbol, error='达到最大持仓数量，无法继续开仓')
 
-        max_affordable_qty = int(portfolio['cash'] / (price * (1 + self.trade_fee_rate)))
-        risk_pct = float(decision.get('risk_budget_pct', 3)) / 100
-        risk_pct = min(max(risk_pct, 0.01), 0.05)
-        risk_based_qty = int((portfolio['cash'] * risk_pct) / (price * (1 + self.trade_fee_rate)))
-
-        quantity = int(quantity)
-        if quantity <= 0 or quantity > max_affordable_qty:
-            quantity = min(max_affordable_qty, risk_based_qty if risk_based_qty > 0 else max_affordable_qty)
+        # 数量已由 _size_buys 批量计算；价格或参数无效时直接返回该标的的错误
+        quantity = ctx.buy_sizes[symbol]
+        if isinstance(quantity, TradeResult):
+            return quantity
 
         if quantity <= 0:
-            return {'coin': symbol, 'error': '现金不足，无法买入'}
+            return TradeResult(symbol, error='现金不足，无法买入')
         
-        trade_amount = quantity * price  # 交易额
-        trade_fee = trade_amount * self.trade_fee_rate  # 交易费（0.1%）
-        required_margin = (quantity * price) / leverage  # 保证金
+        # 交易费（0.1%）与保证金
+        trade_fee, required_margin, _, _ = compute_trade(
+            float(quantity), price, self.trade_fee_rate, float(leverage), price, SIDE_LONG
+        )
         
         # 总需资金 = 保证金 + 交易费
         total_required = required_margin + trade_fee
-        if total_required > portfolio['cash']:
-            return {'coin': symbol, 'error': '可用资金不足（含手续费）'}
+        if total_required > ctx.cash:
+            return TradeResult(symbol, error='可用资金不足（含手续费）')
         
         # 更新持仓
         try:
@@ -184,83 +441,77 @@ class TradingEngine:
                 self.model_id, symbol, quantity, price, leverage, 'long'
             )
         except Exception as db_err:
-            print(f"[TRADE][ERROR] Update position failed (BUY) model={self.model_id} coin={symbol}: {db_err}")
+            logger.error("[TRADE][ERROR] Update position failed (BUY) model=%s coin=%s: %s", self.model_id, symbol, db_err)
             raise
         
         # 记录交易（包含交易费）
-        print(f"[TRADE][PENDING] Model {self.model_id} BUY {symbol} qty={quantity} price={price} fee={trade_fee}")
+        logger.info("[TRADE][PENDING] Model %s BUY %s qty=%s price=%s fee=%s", self.model_id, symbol, quantity, price, trade_fee)
         try:
             self.db.add_trade(
                 self.model_id, symbol, 'buy_to_enter', quantity, 
                 price, leverage, 'long', pnl=0, fee=trade_fee  # 新增fee参数
             )
         except Exception as db_err:
-            print(f"[TRADE][ERROR] Add trade failed (BUY) model={self.model_id} coin={symbol}: {db_err}")
+            logger.error("[TRADE][ERROR] Add trade failed (BUY) model=%s coin=%s: %s", self.model_id, symbol, db_err)
             raise
-        print(f"[TRADE][RECORDED] Model {self.model_id} BUY {symbol}")
+        logger.info("[TRADE][RECORDED] Model %s BUY %s", self.model_id, symbol)
+        # 与数据库口径一致：现金 = 初始资金 + 已实现盈亏 - 占用保证金（覆盖原持仓时释放其保证金）
+        prior = ctx.positions_map.get(symbol)
+        released_margin = prior['quantity'] * prior['avg_price'] / prior['leverage'] if prior else 0.0
+        ctx.cash -= required_margin - released_margin
+        ctx.existing_symbols.add(symbol)
         
-        return {
-            'coin': symbol,
-            'signal': 'buy_to_enter',
-            'quantity': quantity,
-            'price': price,
-            'leverage': leverage,
-            'fee': trade_fee,  # 返回费用信息
-            'message': f'买入 {symbol} {quantity} 股 @ ¥{price:.2f} (手续费: ¥{trade_fee:.2f})'
-        }
+        return TradeResult(
+            symbol,
+            signal='buy_to_enter',
+            quantity=quantity,
+            price=price,
+            leverage=leverage,
+            fee=trade_fee,  # 返回费用信息
+            message=f'买入 {symbol} {quantity} 股 @ ¥{price:.2f} (手续费: ¥{trade_fee:.2f})'
+        )
     
-    def _execute_close(self, symbol: str, decision: Dict, market_state: Dict, 
-                    portfolio: Dict) -> Dict:
-        position = None
-        for pos in portfolio['positions']:
-            if pos['coin'] == symbol:
-                position = pos
-                break
-        
-        if not position:
-            return {'coin': symbol, 'error': 'Position not found'}
-        
+    def _execute_close(self, ctx: CycleCtx, symbol: str, decision: Dict, market_state: Dict) -> TradeResult:
+        position = ctx.positions_map[symbol]
         current_price = market_state[symbol]['price']
         entry_price = position['avg_price']
         quantity = position['quantity']
         side = position['side']
         
-        # 计算平仓利润（未扣费）
-        if side == 'long':
-            gross_pnl = (current_price - entry_price) * quantity
-        else:  # short
-            gross_pnl = (entry_price - current_price) * quantity
-        
-        # 计算平仓交易费（按平仓时的交易额）
-        trade_amount = quantity * current_price
-        trade_fee = trade_amount * self.trade_fee_rate
-        net_pnl = gross_pnl - trade_fee  # 净利润 = 毛利润 - 交易费
+        # 平仓交易费按平仓时的交易额计算；净利润 = 毛利润 - 交易费
+        trade_fee, _, gross_pnl, net_pnl = compute_trade(
+            float(quantity), current_price, self.trade_fee_rate, float(position['leverage']), entry_price,
+            SIDE_LONG if side == 'long' else SIDE_SHORT
+        )
         
         # 关闭持仓
         try:
             self.db.close_position(self.model_id, symbol, side)
         except Exception as db_err:
-            print(f"[TRADE][ERROR] Close position failed model={self.model_id} coin={symbol}: {db_err}")
+            logger.error("[TRADE][ERROR] Close position failed model=%s coin=%s: %s", self.model_id, symbol, db_err)
             raise
         
         # 记录平仓交易（包含费用和净利润）
-        print(f"[TRADE][PENDING] Model {self.model_id} CLOSE {symbol} side={side} qty={quantity} price={current_price} fee={trade_fee} net_pnl={net_pnl}")
+        logger.info("[TRADE][PENDING] Model %s CLOSE %s side=%s qty=%s price=%s fee=%s net_pnl=%s",
+                    self.model_id, symbol, side, quantity, current_price, trade_fee, net_pnl)
         try:
             self.db.add_trade(
                 self.model_id, symbol, 'close_position', quantity,
                 current_price, position['leverage'], side, pnl=net_pnl, fee=trade_fee  # 新增fee参数
             )
         except Exception as db_err:
-            print(f"[TRADE][ERROR] Add trade failed (CLOSE) model={self.model_id} coin={symbol}: {db_err}")
+            logger.error("[TRADE][ERROR] Add trade failed (CLOSE) model=%s coin=%s: %s", self.model_id, symbol, db_err)
             raise
-        print(f"[TRADE][RECORDED] Model {self.model_id} CLOSE {symbol}")
+        logger.info("[TRADE][RECORDED] Model %s CLOSE %s", self.model_id, symbol)
+        ctx.cash += quantity * entry_price / position['leverage'] + net_pnl
+        ctx.existing_symbols.discard(symbol)
         
-        return {
-            'coin': symbol,
-            'signal': 'close_position',
-            'quantity': quantity,
-            'price': current_price,
-            'pnl': net_pnl,
-            'fee': trade_fee,
-            'message': f'平仓 {symbol}, 毛收益 ¥{gross_pnl:.2f}, 手续费 ¥{trade_fee:.2f}, 净收益 ¥{net_pnl:.2f}'
-        }
+        return TradeResult(
+            symbol,
+            signal='close_position',
+            quantity=quantity,
+            price=current_price,
+            pnl=net_pnl,
+            fee=trade_fee,
+            message=f'平仓 {symbol}, 毛收益 ¥{gross_pnl:.2f}, 手续费 ¥{trade_fee:.2f}, 净收益 ¥{net_pnl:.2f}'
+        )